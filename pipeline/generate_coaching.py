@@ -6,9 +6,13 @@ Sends Hub notifications to Team Leaders.
 Uses calendar-week (Mon-Sun) aggregated data from chatter_daily_stats
 and compares current week vs previous week for trend arrows.
 """
-import os, requests, json
-from datetime import datetime, timezone, timedelta
+import os, requests, orjson
+from datetime import datetime, timezone, timedelta, date
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 SUPABASE_URL = os.environ["SUPABASE_URL"]
 SUPABASE_KEY = os.environ["SUPABASE_SERVICE_KEY"]
@@ -17,9 +21,18 @@ HEADERS = {
     "apikey": SUPABASE_KEY,
     "Authorization": f"Bearer {SUPABASE_KEY}",
     "Content-Type": "application/json",
-    "Prefer": "resolution=merge-duplicates",
+    "Prefer": "resolution=merge-duplicates,return=minimal",
 }
 
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3,
+                      status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+))
+
 TL_SHIFTS = {
     "danilyn":  {"start": 0,  "end": 8,  "team": "Team Danilyn"},
     "huckle":   {"start": 0,  "end": 8,  "team": "Team Huckle"},
@@ -28,16 +41,17 @@ TL_SHIFTS = {
 
 MIN_WEEKLY_HOURS = 8
 COACHING_OVERDUE_DAYS = 2
+COACHING_LOOKBACK_DAYS = 60  # batched last-coaching query window; older sessions are looked up per chatter
 TREND_THRESHOLD = 2
 
 
 def sb_get(path):
-    r = requests.get(f"{SUPABASE_URL}/rest/v1/{path}", headers=HEADERS)
-    return r.json() if r.status_code == 200 else []
+    r = SESSION.get(f"{SUPABASE_URL}/rest/v1/{path}")
+    return orjson.loads(r.content) if r.status_code == 200 else []
 
 
 def sb_post(path, data):
-    r = requests.post(f"{SUPABASE_URL}/rest/v1/{path}", headers=HEADERS, json=data)
+    r = SESSION.post(f"{SUPABASE_URL}/rest/v1/{path}", data=orjson.dumps(data))
     return r.status_code in (200, 201)
 
 
@@ -54,20 +68,16 @@ def get_week_bounds(today):
     )
 
 
-def get_current_shift_tls():
-    """Determine which TLs are about to start their shift."""
-    now = datetime.now(timezone.utc)
-    current_hour = now.hour
+# hour (UTC) → TLs whose shift starts this hour or the next; modulo handles the midnight wrap
+_HOUR_TO_TLS = tuple(
+    tuple((n, s) for n, s in TL_SHIFTS.items() if (hour - s["start"]) % 24 in (23, 0))
+    for hour in range(24)
+)
 
-    active_tls = []
-    for tl_name, shift in TL_SHIFTS.items():
-        shift_start = shift["start"]
-        if shift_start == 0 and current_hour == 23:
-            active_tls.append((tl_name, shift))
-        elif current_hour == shift_start - 1 or current_hour == shift_start:
-            active_tls.append((tl_name, shift))
 
-    return active_tls
+def get_current_shift_tls(now):
+    """Determine which TLs are about to start their shift."""
+    return list(_HOUR_TO_TLS[now.hour])
 
 
 SUM_FIELDS = [
@@ -75,6 +85,9 @@ SUM_FIELDS = [
     "messages_sent", "ppvs_sent", "ppvs_unlocked",
 ]
 
+# Only the columns _aggregate_rows reads
+STATS_SELECT = ",".join(["employee_name"] + SUM_FIELDS)
+
 
 def _aggregate_rows(rows):
     """Group daily rows by employee_name and aggregate into weekly stats."""
@@ -106,25 +119,34 @@ def _aggregate_rows(rows):
     return result
 
 
-def get_weekly_stats(team_name, start_date, end_date):
-    """Fetch chatter_daily_stats for a date range, filter by team, aggregate."""
-    stats = sb_get(
-        f"chatter_daily_stats?date=gte.{start_date}&date=lte.{end_date}&order=sales.desc"
+def _normalize_name(name):
+    return " ".join(name.lower().split())
+
+
+def fetch_daily_stats(start_date, end_date):
+    """Fetch all chatter_daily_stats rows for a date range (every team)."""
+    return sb_get(
+        f"chatter_daily_stats?date=gte.{start_date}&date=lte.{end_date}"
+        f"&select={STATS_SELECT}&order=sales.desc"
     )
 
+
+def fetch_team_rosters():
+    """Return {team_name: frozenset(normalized chatter names)} for active chatters."""
     chatters = sb_get(
-        f"chatters?team_name=eq.{team_name}&status=eq.Active&airtable_role=eq.Chatter&select=full_name"
+        "chatters?status=eq.Active&airtable_role=eq.Chatter&select=full_name,team_name"
     )
-    chatter_names = {c["full_name"].lower().strip().replace("  ", " ") for c in chatters}
-    name_map = {}
+    rosters = defaultdict(set)
     for c in chatters:
-        name_map[c["full_name"].lower().strip().replace("  ", " ")] = c["full_name"]
+        if c.get("team_name"):
+            rosters[c["team_name"]].add(_normalize_name(c["full_name"]))
+    return {team: frozenset(names) for team, names in rosters.items()}
+
 
-    team_rows = []
-    for s in stats:
-        key = s["employee_name"].lower().strip().replace("  ", " ")
-        if key in chatter_names:
-            team_rows.append(s)
+def get_weekly_stats(team_name, stats, rosters):
+    """Filter pre-fetched daily stats down to one team and aggregate."""
+    chatter_names = rosters.get(team_name, frozenset())
+    team_rows = [s for s in stats if _normalize_name(s["employee_name"]) in chatter_names]
 
     aggregated = _aggregate_rows(team_rows)
 
@@ -136,62 +158,66 @@ def get_weekly_stats(team_name, start_date, end_date):
     return filtered
 
 
-def get_last_coaching(chatter_name):
-    """Get days since last coaching session for this chatter."""
+def get_last_coaching(chatter_names, today):
+    """Get days since last coaching session for each chatter.
+
+    Recent logs come from one query bounded to COACHING_LOOKBACK_DAYS; chatters with
+    no log in that window fall back to a latest-log lookup of their own.
+    Returns {chatter_name: days}; chatters never coached are left out.
+    """
+    if not chatter_names:
+        return {}
+    quoted = ",".join(
+        '"' + n.replace("\\", "\\\\").replace('"', '\\"') + '"' for n in chatter_names
+    )
+    since = (today - timedelta(days=COACHING_LOOKBACK_DAYS)).isoformat()
     logs = sb_get(
-        f"coaching_logs?chatter_name=eq.{chatter_name}&order=date.desc&limit=1"
+        f"coaching_logs?chatter_name=in.({quote(quoted)})&date=gte.{since}"
+        f"&select=chatter_name,date&order=date.desc"
     )
-    if not logs:
-        return 999
-    last_date = datetime.strptime(logs[0]["date"], "%Y-%m-%d").date()
-    today = datetime.now(timezone.utc).date()
-    return (today - last_date).days
+    last = {}
+    for log in logs:
+        # Ordered by date desc, so the first row per chatter is the latest
+        if log["chatter_name"] not in last:
+            last[log["chatter_name"]] = date.fromisoformat(log["date"][:10])
+
+    # Not coached within the window (or cut off by max-rows, which drops the oldest rows first)
+    for name in chatter_names:
+        if name not in last:
+            older = sb_get(
+                f"coaching_logs?chatter_name=eq.{quote(name)}&select=date&order=date.desc&limit=1"
+            )
+            if older:
+                last[name] = date.fromisoformat(older[0]["date"][:10])
+    return {name: (today - d).days for name, d in last.items()}
+
+
+# (stat field, threshold, KPI label, target shown to TL, coaching actions)
+KPI_RULES = (
+    ("golden", 4, "Golden Ratio", "≥30%",
+     ("Review PPV sending frequency", "Check message quality", "Analyze top performer scripts")),
+    ("cvr", 8, "Fan CVR", "≥8%",
+     ("Review fan engagement approach", "Check first-message strategy", "Analyze conversion funnel")),
+    ("sales_hr", 40, "$/hr", "≥$40",
+     ("Review time management", "Check high-value fan prioritization", "Analyze sales techniques")),
+    ("unlock", 35, "Unlock Rate", "≥20%",
+     ("Review PPV pricing strategy", "Check content quality", "Analyze successful unlocks")),
+)
 
 
 def identify_red_flags(stat):
-    """Identify performance red flags from weekly aggregated stats."""
+    """Identify performance red flags from weekly aggregated stats.
+
+    Returns (red_flags, talking_points), built in a single pass over KPI_RULES.
+    """
     flags = []
-    if stat.get("golden", 0) < 4:
-        flags.append({"kpi": "Golden Ratio", "value": stat["golden"], "threshold": 4})
-    if stat.get("cvr", 0) < 8:
-        flags.append({"kpi": "Fan CVR", "value": stat["cvr"], "threshold": 8})
-    if stat.get("sales_hr", 0) < 40:
-        flags.append({"kpi": "$/hr", "value": stat["sales_hr"], "threshold": 40})
-    if stat.get("unlock", 0) < 35:
-        flags.append({"kpi": "Unlock Rate", "value": stat["unlock"], "threshold": 35})
-    return flags
-
-
-def generate_talking_points(stat, flags):
-    """Generate coaching talking points based on red flags."""
     points = []
-    for flag in flags:
-        kpi = flag["kpi"]
-        if kpi == "Golden Ratio":
-            points.append({
-                "kpi": "Golden Ratio",
-                "target": "≥30%",
-                "actions": ["Review PPV sending frequency", "Check message quality", "Analyze top performer scripts"],
-            })
-        elif kpi == "Fan CVR":
-            points.append({
-                "kpi": "Fan CVR",
-                "target": "≥8%",
-                "actions": ["Review fan engagement approach", "Check first-message strategy", "Analyze conversion funnel"],
-            })
-        elif kpi == "$/hr":
-            points.append({
-                "kpi": "$/hr",
-                "target": "≥$40",
-                "actions": ["Review time management", "Check high-value fan prioritization", "Analyze sales techniques"],
-            })
-        elif kpi == "Unlock Rate":
-            points.append({
-                "kpi": "Unlock Rate",
-                "target": "≥20%",
-                "actions": ["Review PPV pricing strategy", "Check content quality", "Analyze successful unlocks"],
-            })
-    return points
+    for field, threshold, kpi, target, actions in KPI_RULES:
+        value = stat.get(field, 0)
+        if value < threshold:
+            flags.append({"kpi": kpi, "value": value, "threshold": threshold})
+            points.append({"kpi": kpi, "target": target, "actions": actions})
+    return flags, points
 
 
 def compute_trend(current_score, prev_stats, chatter_name):
@@ -226,16 +252,23 @@ def send_hub_notification(tl_team, task_count, date):
         tl_name = tl_team.replace("Team ", "").lower()
         profiles = [p for p in profiles if tl_name in p.get("full_name", "").lower()]
 
-    for p in profiles:
-        sb_post("notifications", {
-            "user_id": p["id"],
-            "type": "coaching",
-            "title": f"🎯 {task_count} coaching tasks for today",
-            "message": f"Your coaching queue for {date} is ready. {task_count} chatters need attention.",
-            "read": False,
-            "action_url": "/coaching-queue",
-        })
-        print(f"  📬 Notification sent to {p['full_name']}")
+    if not profiles:
+        return
+
+    notifications = [{
+        "user_id": p["id"],
+        "type": "coaching",
+        "title": f"🎯 {task_count} coaching tasks for today",
+        "message": f"Your coaching queue for {date} is ready. {task_count} chatters need attention.",
+        "read": False,
+        "action_url": "/coaching-queue",
+    } for p in profiles]
+
+    if sb_post("notifications", notifications):
+        for p in profiles:
+            print(f"  📬 Notification sent to {p['full_name']}")
+    else:
+        print(f"  ⚠️ Failed to send notifications for {tl_team}")
 
 
 def main():
@@ -247,69 +280,94 @@ def main():
     print(f"  📅 Current week: {curr_monday} → {today}")
     print(f"  📅 Previous week: {prev_monday} → {prev_sunday}")
 
-    active_tls = get_current_shift_tls()
+    active_tls = get_current_shift_tls(now)
 
     if not active_tls:
         print("  No TL shifts starting now, checking all teams...")
         active_tls = list(TL_SHIFTS.items())
 
+    # Stats and rosters are the same for every team — fetch each once, in parallel
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        curr_future = ex.submit(fetch_daily_stats, curr_monday, today)
+        prev_future = ex.submit(fetch_daily_stats, prev_monday, prev_sunday)
+        rosters_future = ex.submit(fetch_team_rosters)
+    curr_rows = curr_future.result()
+    prev_rows = prev_future.result()
+    rosters = rosters_future.result()
+
     for tl_name, shift in active_tls:
         team = shift["team"]
         print(f"\n  🏷️ Processing {team} (TL: {tl_name})...")
 
-        curr_stats = get_weekly_stats(team, curr_monday, today)
-        prev_stats = get_weekly_stats(team, prev_monday, prev_sunday)
+        curr_stats = get_weekly_stats(team, curr_rows, rosters)
+        prev_stats = get_weekly_stats(team, prev_rows, rosters)
         print(f"    Chatters this week: {len(curr_stats)}, last week: {len(prev_stats)}")
 
-        tasks_created = 0
+        last_coaching = get_last_coaching(list(curr_stats), today_date)
+
+        # Fields shared by every task for this team
+        task_base = {
+            "date": today,
+            "team_tl": tl_name,
+            "perf_source": "inflow_weekly",
+            "status": "pending",
+        }
+
+        tasks_batch = []
         for chatter_name, stat in curr_stats.items():
-            days_since = get_last_coaching(chatter_name)
-            red_flags = identify_red_flags(stat)
+            days_since = last_coaching.get(chatter_name, 999)
+            red_flags, talking_points = identify_red_flags(stat)
+            flag_count = len(red_flags)
 
             priority = 0
             if days_since >= COACHING_OVERDUE_DAYS:
                 priority += 2
-            if len(red_flags) >= 2:
+            if flag_count >= 2:
                 priority += 2
-            elif len(red_flags) >= 1:
+            elif flag_count >= 1:
                 priority += 1
 
             if priority == 0:
                 continue
 
-            talking_points = generate_talking_points(stat, red_flags)
+            sales_hr = stat["sales_hr"]
             prev_score, trend_arrow, trend_delta = compute_trend(
-                stat["sales_hr"], prev_stats, chatter_name,
+                sales_hr, prev_stats, chatter_name,
             )
 
             task = {
-                "date": today,
+                **task_base,
                 "chatter_name": chatter_name,
-                "team_tl": tl_name,
                 "priority": priority,
-                "perf_score": stat["sales_hr"],
+                "perf_score": sales_hr,
                 "prev_score": prev_score,
                 "trend_arrow": trend_arrow,
                 "trend_delta": trend_delta,
                 "days_since_coaching": days_since,
-                "red_flags": json.dumps(red_flags),
-                "talking_points": json.dumps(talking_points),
-                "kpis": json.dumps({
+                "red_flags": orjson.dumps(red_flags).decode(),
+                "talking_points": orjson.dumps(talking_points).decode(),
+                "kpis": orjson.dumps({
                     "sales": stat["sales"],
-                    "sales_hr": stat["sales_hr"],
+                    "sales_hr": sales_hr,
                     "golden": stat["golden"],
                     "cvr": stat["cvr"],
                     "unlock": stat["unlock"],
                     "msg_hr": stat["msg_hr"],
                     "hours": stat["hours"],
                     "days": stat["days_with_data"],
-                }),
-                "perf_source": "inflow_weekly",
-                "status": "pending",
+                }).decode(),
             }
 
-            if sb_post("coaching_tasks", task):
-                tasks_created += 1
+            tasks_batch.append(task)
+
+        tasks_created = 0
+        if tasks_batch:
+            if sb_post("coaching_tasks", tasks_batch):
+                tasks_created = len(tasks_batch)
+            else:
+                # Bulk insert rejected — retry row by row so one bad task doesn't drop the rest
+                print("    ⚠️ Bulk insert failed, retrying tasks individually...")
+                tasks_created = sum(1 for t in tasks_batch if sb_post("coaching_tasks", t))
 
         print(f"    ✅ {tasks_created} coaching tasks created")
 
@@ -12,8 +12,12 @@ Usage:
 Env vars (same as sync_hubstaff.py):
   HUBSTAFF_TOKEN, SUPABASE_URL, SUPABASE_SERVICE_KEY
 """
-import os, sys, unicodedata, requests
+import os, sys, unicodedata, functools, requests, orjson
 from datetime import datetime, timezone
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 HUBSTAFF_REFRESH_TOKEN = os.environ["HUBSTAFF_TOKEN"]
 SUPABASE_URL = os.environ["SUPABASE_URL"]
@@ -24,99 +28,141 @@ HEADERS_SB = {
     "apikey": SUPABASE_KEY,
     "Authorization": f"Bearer {SUPABASE_KEY}",
     "Content-Type": "application/json",
-    "Prefer": "resolution=merge-duplicates",
+    "Prefer": "resolution=merge-duplicates,return=minimal",
 }
 
 SKIP_ORGS = {529677}
+ORG_WORKERS = 4  # orgs paginated concurrently; keeps us well under Hubstaff rate limits
 
 
+def _make_session(headers=None):
+    """Session with a keep-alive connection pool and retries on transient errors."""
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=20,
+        max_retries=Retry(total=3, backoff_factor=0.3,
+                          status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+    ))
+    return session
+
+
+SESSION_SB = _make_session(HEADERS_SB)
+SESSION_HS = _make_session()
+
+
+# Combining Diacritical Marks blocks → deleted (these are what NFD splits accents into)
+_COMBINING_MARKS = {
+    c: None
+    for lo, hi in ((0x0300, 0x036F), (0x1AB0, 0x1AFF), (0x1DC0, 0x1DFF), (0x20D0, 0x20FF), (0xFE20, 0xFE2F))
+    for c in range(lo, hi + 1)
+}
+
+
+@functools.lru_cache(maxsize=4096)
 def strip_accents(s: str) -> str:
-    return "".join(
-        c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn"
-    )
+    return unicodedata.normalize("NFD", s).translate(_COMBINING_MARKS)
 
 
+@functools.lru_cache(maxsize=4096)
 def normalize(name: str) -> str:
-    return strip_accents(name).lower().strip().replace("  ", " ")
+    return " ".join(strip_accents(name).lower().split())
 
 
 # ── Hubstaff auth (reused from sync_hubstaff.py) ──────────────
 
 def get_stored_refresh_token():
-    r = requests.get(
+    r = SESSION_SB.get(
         f"{SUPABASE_URL}/rest/v1/app_settings?key=eq.hubstaff_refresh_token&select=value",
-        headers=HEADERS_SB,
     )
     if r.status_code == 200:
-        rows = r.json()
+        rows = orjson.loads(r.content)
         if rows and rows[0].get("value"):
             return rows[0]["value"]
     return None
 
 
 def store_refresh_token(token):
-    requests.post(
+    SESSION_SB.post(
         f"{SUPABASE_URL}/rest/v1/app_settings?on_conflict=key",
-        headers={**HEADERS_SB, "Prefer": "resolution=merge-duplicates"},
-        json={"key": "hubstaff_refresh_token", "value": token},
+        data=orjson.dumps({"key": "hubstaff_refresh_token", "value": token}),
     )
 
 
 def exchange_for_access_token(refresh_token):
-    r = requests.post(TOKEN_ENDPOINT, data={
+    r = SESSION_HS.post(TOKEN_ENDPOINT, data={
         "grant_type": "refresh_token",
         "refresh_token": refresh_token,
     })
     if r.status_code != 200:
         print(f"  Token exchange failed ({r.status_code}): {r.text[:200]}")
         return None, None
-    data = r.json()
+    data = orjson.loads(r.content)
     return data.get("access_token"), data.get("refresh_token")
 
 
 def hubstaff_get(path, access_token, params=None):
-    r = requests.get(
+    r = SESSION_HS.get(
         f"https://api.hubstaff.com/v2/{path}",
         headers={"Authorization": f"Bearer {access_token}"},
         params=params or {},
     )
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
 # ── Collect all Hubstaff users across orgs ─────────────────────
 
+def _fetch_org_members(org_id, access_token):
+    """Walk one org's member pages. Returns (user_ids, {user_id: name} from the sideload)."""
+    user_ids = []
+    names = {}
+    page_start = None
+    while True:
+        params = {"page_limit": 500, "include": "users"}
+        if page_start:
+            params["page_start_id"] = page_start
+        data = hubstaff_get(f"organizations/{org_id}/members", access_token, params)
+        members = data.get("members", [])
+        if not members:
+            break
+        # Sideloaded user records carry the names, so no per-user lookup is needed
+        for u in data.get("users", []):
+            if u.get("id") and u.get("name"):
+                names[u["id"]] = u["name"]
+        for m in members:
+            uid = m.get("user_id")
+            if uid:
+                user_ids.append(uid)
+        # Hubstaff only returns next_page_start_id when another page exists
+        page_start = data.get("pagination", {}).get("next_page_start_id")
+        if not page_start:
+            break
+    return user_ids, names
+
+
 def get_all_hubstaff_users(access_token):
     """Returns dict {user_id: name} across all active orgs."""
     orgs = hubstaff_get("organizations", access_token).get("organizations", [])
     active_orgs = [o for o in orgs if o["id"] not in SKIP_ORGS]
     print(f"  Active orgs: {len(active_orgs)}")
 
+    # Pages within an org are sequential, but orgs are independent — walk them concurrently
+    with ThreadPoolExecutor(max_workers=ORG_WORKERS) as ex:
+        org_members = list(ex.map(lambda o: _fetch_org_members(o["id"], access_token), active_orgs))
+
     all_users = {}  # user_id → name
 
-    for org in active_orgs:
+    for org, (user_ids, names) in zip(active_orgs, org_members):
         org_id = org["id"]
         org_name = org.get("name", f"Org {org_id}")
         print(f"\n  --- {org_name} (ID: {org_id}) ---")
 
-        user_ids = []
-        page_start = None
-        while True:
-            params = {"page_limit": 100}
-            if page_start:
-                params["page_start_id"] = page_start
-            data = hubstaff_get(f"organizations/{org_id}/members", access_token, params)
-            members = data.get("members", [])
-            if not members:
-                break
-            for m in members:
-                uid = m.get("user_id")
-                if uid:
-                    user_ids.append(uid)
-            if len(members) < 100:
-                break
-            page_start = members[-1].get("id")
+        all_users.update(names)
 
+        # Fall back to per-user lookups only for members the sideload didn't cover
         for uid in user_ids:
             if uid in all_users:
                 continue
@@ -159,11 +205,10 @@ def main():
 
     # Fetch Supabase chatters
     print("\n[2/3] Fetching Supabase chatters...")
-    r = requests.get(
-        f"{SUPABASE_URL}/rest/v1/chatters?select=id,full_name,hubstaff_user_id,status",
-        headers=HEADERS_SB,
+    r = SESSION_SB.get(
+        f"{SUPABASE_URL}/rest/v1/chatters?select=id,airtable_id,full_name,hubstaff_user_id,status",
     )
-    chatters = r.json() if r.status_code == 200 else []
+    chatters = orjson.loads(r.content) if r.status_code == 200 else []
     print(f"  Total chatters: {len(chatters)}")
 
     already_mapped = {c["hubstaff_user_id"] for c in chatters if c.get("hubstaff_user_id")}
@@ -171,11 +216,20 @@ def main():
 
     # Build normalized-name → chatter lookup (only unmapped chatters)
     name_to_chatter = {}
+    chatter_norm = {}  # chatter id → normalized name
     for c in chatters:
         if c.get("hubstaff_user_id"):
             continue
         key = normalize(c["full_name"])
         name_to_chatter[key] = c
+        chatter_norm[c["id"]] = key
+
+    # "first last" → unmapped chatters sharing it, for the partial-name fallback
+    fl_index = defaultdict(list)
+    for key, c in name_to_chatter.items():
+        c_parts = key.split()
+        if len(c_parts) >= 2:
+            fl_index[f"{c_parts[0]} {c_parts[-1]}"].append(c)
 
     # Match
     print("\n[3/3] Matching...")
@@ -196,16 +250,17 @@ def main():
             parts = norm_hs.split()
             if len(parts) >= 2:
                 first_last = f"{parts[0]} {parts[-1]}"
-                for key, c in name_to_chatter.items():
-                    c_parts = key.split()
-                    c_first_last = f"{c_parts[0]} {c_parts[-1]}" if len(c_parts) >= 2 else key
-                    if first_last == c_first_last:
-                        chatter = c
-                        break
+                candidates = [
+                    c for c in fl_index.get(first_last, ())
+                    if name_to_chatter.get(chatter_norm[c["id"]]) is c
+                ]
+                # Skip ambiguous first+last collisions rather than guess
+                if len(candidates) == 1:
+                    chatter = candidates[0]
 
         if chatter:
             matched.append((uid, chatter["id"], hs_name, chatter["full_name"]))
-            del name_to_chatter[normalize(chatter["full_name"])]
+            del name_to_chatter[chatter_norm[chatter["id"]]]
         else:
             unmatched_hs.append((uid, hs_name))
 
@@ -235,15 +290,25 @@ def main():
     # Write matches
     if matched and not dry_run:
         print(f"\n  Writing {len(matched)} mappings to Supabase...")
-        for uid, cid, _, _ in matched:
-            r = requests.patch(
-                f"{SUPABASE_URL}/rest/v1/chatters?id=eq.{cid}",
-                headers=HEADERS_SB,
-                json={"hubstaff_user_id": uid},
-            )
-            if r.status_code not in (200, 204):
-                print(f"    ERROR updating chatter {cid}: {r.status_code} {r.text[:200]}")
-        print("  Done!")
+        chatter_by_id = {c["id"]: c for c in chatters}
+        # Upsert needs the NOT NULL columns too; existing values are written back unchanged
+        payload = [
+            {
+                "id": cid,
+                "airtable_id": chatter_by_id[cid]["airtable_id"],
+                "full_name": chatter_by_id[cid]["full_name"],
+                "hubstaff_user_id": uid,
+            }
+            for uid, cid, _, _ in matched
+        ]
+        r = SESSION_SB.post(
+            f"{SUPABASE_URL}/rest/v1/chatters?on_conflict=id",
+            data=orjson.dumps(payload),
+        )
+        if r.status_code in (200, 201, 204):
+            print("  Done!")
+        else:
+            print(f"    ERROR writing mappings: {r.status_code} {r.text[:200]}")
     elif dry_run and matched:
         print(f"\n  DRY RUN — would write {len(matched)} mappings")
 
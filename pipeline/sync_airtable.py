@@ -2,8 +2,11 @@
 Sync chatters, models, and teams from Airtable → Supabase.
 Runs every 6 hours via GitHub Actions.
 """
-import os, json, requests, hashlib
+import os, re, json, gzip, requests, hashlib, orjson
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 AIRTABLE_TOKEN = os.environ["AIRTABLE_TOKEN"]
 AIRTABLE_BASE = os.environ.get("AIRTABLE_BASE_ID", "appy0qGaMEfyDz9LZ")
@@ -15,9 +18,33 @@ HEADERS_SB = {
     "apikey": SUPABASE_KEY,
     "Authorization": f"Bearer {SUPABASE_KEY}",
     "Content-Type": "application/json",
-    "Prefer": "resolution=merge-duplicates",
+    "Prefer": "resolution=merge-duplicates,return=minimal",
 }
 
+
+def _make_session(headers=None):
+    """Session with a keep-alive connection pool and retries on transient errors."""
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=20,
+        max_retries=Retry(total=3, backoff_factor=0.3,
+                          status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+    ))
+    return session
+
+
+SESSION_AT = _make_session(HEADERS_AT)
+SESSION_SB = _make_session(HEADERS_SB)
+SESSION_MEDIA = _make_session()
+
+# Opt-in: gzip upsert bodies of GZIP_MIN_BYTES or more (repetitive JSON keys shrink 5-10x).
+# PostgREST doesn't decode gzip itself — only enable once the project's gateway is confirmed to.
+GZIP_UPSERTS = os.environ.get("SUPABASE_GZIP_UPSERTS") == "1"
+GZIP_MIN_BYTES = 16 * 1024
+
 # Fields that map to dedicated columns (not stored in details JSONB)
 MAPPED_MODEL_FIELDS = {
     "Model Name", "Name", "Status", "Page Type", "Profile Picture",
@@ -161,18 +188,38 @@ def _build_standardized_details(fields):
     return details
 
 
+_UNKNOWN_FIELD = re.compile(r'Unknown field name: "(.+)"')
+
+def _unknown_field(r):
+    """Name of the field an Airtable 422 UNKNOWN_FIELD_NAME response complains about, or None."""
+    try:
+        error = orjson.loads(r.content).get("error", {})
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(error, dict) or error.get("type") != "UNKNOWN_FIELD_NAME":
+        return None
+    m = _UNKNOWN_FIELD.search(error.get("message", ""))
+    return m.group(1) if m else None
+
 def fetch_airtable(table_id, fields=None):
-    """Fetch all records from an Airtable table, handling pagination."""
+    """Fetch all records from an Airtable table, handling pagination.
+    fields are applied server-side so only needed data is transferred;
+    requested fields the table doesn't have are dropped from the projection."""
     records = []
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE}/{table_id}"
-    params = {}
+    params = {"pageSize": 100}
     if fields:
-        params["fields[]"] = fields
+        params["fields[]"] = list(fields)
     
     while True:
-        r = requests.get(url, headers=HEADERS_AT, params=params)
+        r = SESSION_AT.get(url, params=params)
+        if r.status_code == 422 and "offset" not in params and params.get("fields[]"):
+            unknown = _unknown_field(r)
+            if unknown in params["fields[]"]:
+                params["fields[]"].remove(unknown)
+                continue
         r.raise_for_status()
-        data = r.json()
+        data = orjson.loads(r.content)
         records.extend(data.get("records", []))
         offset = data.get("offset")
         if not offset:
@@ -186,22 +233,28 @@ def fetch_supabase(table, select="*", filters=None):
     url = f"{SUPABASE_URL}/rest/v1/{table}?select={select}"
     if filters:
         url += "&" + "&".join(f"{k}={v}" for k, v in filters.items())
-    headers = {**HEADERS_SB, "Prefer": ""}
-    r = requests.get(url, headers=headers)
+    r = SESSION_SB.get(url, headers={"Prefer": ""})
     if r.status_code != 200:
-        print(f"  Error fetching {table}: {r.status_code} {r.text[:200]}")
+        print(f"  [{table}] Error fetching: {r.status_code} {r.text[:200]}")
         return []
-    return r.json()
+    return orjson.loads(r.content)
 
 def upsert_supabase(table, rows, on_conflict="airtable_id"):
     """Upsert rows to Supabase."""
     if not rows:
         return 0
     url = f"{SUPABASE_URL}/rest/v1/{table}?on_conflict={on_conflict}"
-    headers = {**HEADERS_SB, "Prefer": "resolution=merge-duplicates"}
-    r = requests.post(url, headers=headers, json=rows)
+    body = orjson.dumps(rows)
+    if GZIP_UPSERTS and len(body) >= GZIP_MIN_BYTES:
+        r = SESSION_SB.post(url, headers={"Content-Encoding": "gzip"},
+                            data=gzip.compress(body, compresslevel=1))
+        if r.status_code in (400, 415):
+            print(f"  [{table}] WARNING: gzip upsert rejected ({r.status_code}) — unset SUPABASE_GZIP_UPSERTS")
+            r = SESSION_SB.post(url, data=body)
+    else:
+        r = SESSION_SB.post(url, data=body)
     if r.status_code not in (200, 201):
-        print(f"  Error upserting {table}: {r.status_code} {r.text[:300]}")
+        print(f"  [{table}] Error upserting: {r.status_code} {r.text[:300]}")
         return 0
     return len(rows)
 
@@ -210,10 +263,9 @@ def insert_supabase(table, rows):
     if not rows:
         return 0
     url = f"{SUPABASE_URL}/rest/v1/{table}"
-    headers = {**HEADERS_SB, "Prefer": ""}
-    r = requests.post(url, headers=headers, json=rows)
+    r = SESSION_SB.post(url, headers={"Prefer": "return=minimal"}, data=orjson.dumps(rows))
     if r.status_code not in (200, 201):
-        print(f"  Error inserting {table}: {r.status_code} {r.text[:300]}")
+        print(f"  [{table}] Error inserting: {r.status_code} {r.text[:300]}")
         return 0
     return len(rows)
 
@@ -231,10 +283,23 @@ def _serialize_value(val):
 
 ACTIVE_STATUSES = {"Active"}
 
+# Not part of a row's content hash: sync bookkeeping, and team_name which is Hub-owned after creation
+HASH_EXCLUDED_FIELDS = {"synced_at", "team_name", "row_hash"}
+
+
+def _row_hash(row):
+    """Stable short hash of a row's Airtable-sourced content, for skipping unchanged rows."""
+    content = {k: v for k, v in row.items() if k not in HASH_EXCLUDED_FIELDS}
+    return hashlib.blake2b(orjson.dumps(content, option=orjson.OPT_SORT_KEYS), digest_size=8).hexdigest()
+
+# Only the Chatter fields sync_chatters reads (the table has ~47)
+# Only the Chatter fields sync_chatters reads (the table has ~47) — same names generate_seed_sql uses
+CHATTER_FIELDS = ["Full Name", "\u26a1\ufe0fRol", "\u26a1\ufe0fStatus", "Favorite Shift"]
+
 def build_chatter_team_map():
     """Fetch Teams table and build chatter_record_id → team_name mapping.
     The relationship goes Teams.Chatter → linked chatter records (not the other way)."""
-    print("🏷️  Building chatter→team mapping...")
+    print("[chatters] 🏷️  Building chatter→team mapping...")
     records = fetch_airtable("tblGTOPvVCQTbEHsW", fields=["Equipo", "Chatter"])
     mapping = {}
     for rec in records:
@@ -244,38 +309,43 @@ def build_chatter_team_map():
             continue
         for chatter_id in f.get("Chatter", []):
             mapping[chatter_id] = equipo
-    print(f"  Mapped {len(mapping)} chatters to teams")
+    print(f"  [chatters] Mapped {len(mapping)} chatters to teams")
     return mapping
 
 def sync_chatters():
     """Sync Chatter table from Airtable, respecting ⚡Status field.
     team_name is only set for NEW chatters (not yet in Supabase).
     Existing chatters keep their Hub-assigned team_name."""
-    print("📋 Syncing chatters...")
-    chatter_team_map = build_chatter_team_map()
-
-    existing = fetch_supabase("chatters", select="airtable_id")
-    existing_ids = {c["airtable_id"] for c in existing}
-    print(f"  {len(existing_ids)} chatters already in Supabase")
-
-    records = fetch_airtable("tblBrbCZyL5ub48zc")
+    print("[chatters] 📋 Syncing chatters...")
+    # The two reads are independent — overlap their network waits
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        existing_future = ex.submit(fetch_supabase, "chatters", select="airtable_id,row_hash")
+        # No status filter: inactive chatters are still needed to flip their status
+        records_future = ex.submit(fetch_airtable, "tblBrbCZyL5ub48zc", fields=CHATTER_FIELDS)
+    existing = existing_future.result()
+    records = records_future.result()
+
+    existing_hashes = {c["airtable_id"]: c.get("row_hash") for c in existing}
+    print(f"  [chatters] {len(existing_hashes)} chatters already in Supabase")
     
     rows = []
     new_count = 0
     active_count = 0
+    unchanged_count = 0
+    now = datetime.now(timezone.utc).isoformat()
     for rec in records:
         f = rec.get("fields", {})
-        name = f.get("Name", f.get("Full Name", ""))
+        name = f.get("Full Name", "")
         if not name:
             continue
         
         role = f.get("⚡️Rol", "")
-        at_status = f.get("\u26a1\ufe0fStatus", f.get("\u26a1Status", ""))
+        at_status = f.get("\u26a1\ufe0fStatus", "")
         status = "Active" if at_status in ACTIVE_STATUSES else "Inactive"
         if status == "Active":
             active_count += 1
         
-        is_new = rec["id"] not in existing_ids
+        is_new = rec["id"] not in existing_hashes
 
         row = {
             "airtable_id": rec["id"],
@@ -283,30 +353,47 @@ def sync_chatters():
             "status": status,
             "airtable_role": role or None,
             "favorite_shift": f.get("Favorite Shift", None),
-            "synced_at": datetime.now(timezone.utc).isoformat(),
+            "synced_at": now,
         }
+        row["row_hash"] = _row_hash(row)
+
+        if not is_new and existing_hashes[rec["id"]] == row["row_hash"]:
+            unchanged_count += 1
+            continue
 
         if is_new:
-            row["team_name"] = chatter_team_map.get(rec["id"])
             new_count += 1
 
         rows.append(row)
+
+    # Teams only seed team_name on new chatters, so the Teams table is read only when there are some
+    if new_count:
+        chatter_team_map = build_chatter_team_map()
+        for row in rows:
+            if row["airtable_id"] not in existing_hashes:
+                row["team_name"] = chatter_team_map.get(row["airtable_id"])
     
     count = upsert_supabase("chatters", rows)
-    print(f"  ✅ {count} chatters synced ({active_count} active, {new_count} new, team_name preserved for existing)")
+    print(f"  [chatters] ✅ {count} chatters synced ({active_count} active, {new_count} new, {unchanged_count} unchanged skipped, team_name preserved for existing)")
 
 def _build_client_name_map():
     """Fetch Clients table and build record_id → client name mapping."""
-    print("  📇 Building client name map...")
+    print("  [models] 📇 Building client name map...")
     records = fetch_airtable("tblkawE86Yxsu5fIr", fields=["Full Name"])
     mapping = {}
     for rec in records:
         name = rec.get("fields", {}).get("Full Name", "")
         if name:
             mapping[rec["id"]] = name.strip()
-    print(f"  Mapped {len(mapping)} clients")
+    print(f"  [models] Mapped {len(mapping)} clients")
     return mapping
 
+def _as_list(val):
+    """Coerce an Airtable multi-select/linked field to a list (single strings get wrapped)."""
+    if type(val) is list:
+        return val
+    return [val] if isinstance(val, str) else []
+
 def _resolve_linked(val, name_map):
     """Resolve linked record IDs to names using a map. Returns a name or None."""
     if isinstance(val, list):
@@ -320,7 +407,7 @@ def _resolve_linked(val, name_map):
 def _upload_avatar(airtable_id, airtable_pic_url):
     """Download photo from Airtable and upload to Supabase Storage. Returns permanent public URL or None."""
     try:
-        resp = requests.get(airtable_pic_url, timeout=15)
+        resp = SESSION_MEDIA.get(airtable_pic_url, timeout=15)
         if resp.status_code != 200:
             return None
         content_type = resp.headers.get("Content-Type", "image/jpeg")
@@ -335,33 +422,33 @@ def _upload_avatar(airtable_id, airtable_pic_url):
         file_path = f"{airtable_id}.{ext}"
         upload_url = f"{SUPABASE_URL}/storage/v1/object/model-avatars/{file_path}"
         upload_headers = {
-            "apikey": SUPABASE_KEY,
-            "Authorization": f"Bearer {SUPABASE_KEY}",
             "Content-Type": content_type,
+            "Prefer": None,
             "x-upsert": "true",
         }
-        up = requests.put(upload_url, headers=upload_headers, data=resp.content)
+        up = SESSION_SB.put(upload_url, headers=upload_headers, data=resp.content)
         if up.status_code in (200, 201):
             return f"{SUPABASE_URL}/storage/v1/object/public/model-avatars/{file_path}"
         else:
-            print(f"    ⚠️ Upload failed for {airtable_id}: {up.status_code} {up.text[:100]}")
+            print(f"    [models] ⚠️ Upload failed for {airtable_id}: {up.status_code} {up.text[:100]}")
             return None
     except Exception as e:
-        print(f"    ⚠️ Avatar error for {airtable_id}: {e}")
+        print(f"    [models] ⚠️ Avatar error for {airtable_id}: {e}")
         return None
 
 
 def sync_models():
     """Sync Models table from Airtable with change detection and details JSONB."""
-    print("🎭 Syncing models...")
-
-    client_map = _build_client_name_map()
-
-    # Fetch current state from Supabase for change detection
-    existing = fetch_supabase("models", select="airtable_id,name,status,page_type,niche,traffic_sources,client_name,team_names,chatbot_active,scripts_url,details")
-    existing_map = {m["airtable_id"]: m for m in existing}
-
-    records = fetch_airtable("tbl97sE9V8wbcgjAJ")
+    print("[models] 🎭 Syncing models...")
+
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        client_map_future = ex.submit(_build_client_name_map)
+        # Fetch current state from Supabase for change detection
+        existing_future = ex.submit(fetch_supabase, "models", select="airtable_id,name,status,page_type,niche,traffic_sources,client_name,team_names,chatbot_active,scripts_url,details")
+        records_future = ex.submit(fetch_airtable, "tbl97sE9V8wbcgjAJ")
+    client_map = client_map_future.result()
+    existing_map = {m["airtable_id"]: m for m in existing_future.result()}
+    records = records_future.result()
     
     rows = []
     all_changes = []
@@ -377,17 +464,9 @@ def sync_models():
         if status not in ("Live", "On Hold", "Dead", "Pending Invoice"):
             status = "Live"
         
-        niche = f.get("Niche", [])
-        if isinstance(niche, str):
-            niche = [niche]
-        
-        traffic = f.get("Traffic Sources", f.get("Traffic", []))
-        if isinstance(traffic, str):
-            traffic = [traffic]
-        
-        teams = f.get("Team", [])
-        if isinstance(teams, str):
-            teams = [teams]
+        niche = _as_list(f.get("Niche"))
+        traffic = _as_list(f.get("Traffic Sources", f.get("Traffic")))
+        teams = _as_list(f.get("Team"))
 
         pic_url = None
         pics = f.get("Profile Picture", [])
@@ -472,7 +551,7 @@ def sync_models():
         rows.append(new_row)
     
     count = upsert_supabase("models", rows)
-    print(f"  ✅ {count} models synced")
+    print(f"  [models] ✅ {count} models synced")
 
     # Log detected changes (need to resolve airtable_id → model uuid)
     if all_changes:
@@ -491,12 +570,16 @@ def sync_models():
             })
         if change_rows:
             inserted = insert_supabase("model_changes", change_rows)
-            print(f"  📝 {inserted} field changes logged")
+            print(f"  [models] 📝 {inserted} field changes logged")
     else:
-        print("  📝 No field changes detected")
+        print("  [models] 📝 No field changes detected")
 
 if __name__ == "__main__":
     print(f"🔄 Airtable sync started at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}")
-    sync_chatters()
-    sync_models()
+    # Chatters and models touch separate tables — run both syncs side by side
+    # (their log lines interleave, so each is tagged [chatters]/[models] or with its table)
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        futures = [ex.submit(sync_chatters), ex.submit(sync_models)]
+    for fut in futures:
+        fut.result()  # re-raise a failure from either sync
     print("✅ Airtable sync complete!")
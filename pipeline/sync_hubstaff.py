@@ -16,8 +16,13 @@ Matching strategy (priority order):
   1. chatters.hubstaff_user_id (reliable, set by map_hubstaff_users.py)
   2. Normalized full_name fallback (for unmapped chatters, with warning)
 """
-import os, sys, unicodedata, requests
+import os, time, argparse, functools, unicodedata, requests, orjson
 from datetime import datetime, timezone, timedelta
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 HUBSTAFF_REFRESH_TOKEN = os.environ["HUBSTAFF_TOKEN"]
 SUPABASE_URL = os.environ["SUPABASE_URL"]
@@ -33,126 +38,410 @@ HEADERS_SB = {
 
 SKIP_ORGS = {529677}  # Only Elite Angels — legacy org, not CW
 
+ACCESS_TOKEN_MIN_TTL = 300  # reuse a cached access token only if it has >5 min left
+MEMBER_CACHE_TTL = 24 * 3600  # re-walk an org's member list at most once a day
+CHATTER_SNAPSHOT_KEY = "hubstaff_chatters_snapshot"
+CHATTER_SNAPSHOT_TTL = 24 * 3600  # full re-read of chatters at most a day apart
+USER_LOOKUP_WORKERS = 16  # concurrent users/{uid} GETs (each reuses a pooled connection)
+
+
+# Transient Hubstaff/Supabase failures back off (0.5s, 1s, 2s, … plus jitter) instead of
+# failing the run; Retry-After on 429s is honoured. POSTs on these sessions are Supabase
+# upserts (idempotent), so they're retried too. The final response is returned, not raised.
+HTTP_RETRY = Retry(
+    total=5,
+    backoff_factor=0.5,
+    backoff_jitter=0.25,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset(["GET", "POST"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# Refresh-token exchanges are NOT idempotent — Hubstaff rotates the refresh token, so replaying
+# one the server already processed (after a 5xx or read timeout) sends a spent token. Only
+# retry when the request provably wasn't processed: connection failures and 429s.
+TOKEN_RETRY = Retry(
+    total=3,
+    connect=3,
+    read=0,
+    other=0,
+    backoff_factor=0.5,
+    status_forcelist=[429],
+    allowed_methods=frozenset(["POST"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+def _make_session(headers=None, pool_maxsize=32, pool_block=False, retry=HTTP_RETRY):
+    """Session with a keep-alive connection pool and retries on transient errors.
+    With pool_block, bursts wait for a pooled connection instead of opening throwaway ones."""
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+        max_retries=retry,
+    ))
+    return session
+
+
+SESSION_SB = _make_session(HEADERS_SB)
+# One connection per lookup worker: at most USER_LOOKUP_WORKERS TLS handshakes to Hubstaff per run
+SESSION_HS = _make_session(pool_maxsize=USER_LOOKUP_WORKERS, pool_block=True)
+SESSION_TOKEN = _make_session(pool_maxsize=1, retry=TOKEN_RETRY)
+
 DEFAULT_LOOKBACK_DAYS = 14
 MAX_BACKFILL_DAYS = 90
 
 
+# Combining Diacritical Marks blocks → deleted (these are what NFD splits accents into)
+_COMBINING_MARKS = {
+    c: None
+    for lo, hi in ((0x0300, 0x036F), (0x1AB0, 0x1AFF), (0x1DC0, 0x1DFF), (0x20D0, 0x20FF), (0xFE20, 0xFE2F))
+    for c in range(lo, hi + 1)
+}
+
+
 def strip_accents(s: str) -> str:
-    return "".join(
-        c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn"
-    )
+    return unicodedata.normalize("NFD", s).translate(_COMBINING_MARKS)
 
 
+@functools.lru_cache(maxsize=None)
 def normalize(name: str) -> str:
-    return strip_accents(name).lower().strip().replace("  ", " ")
+    return " ".join(strip_accents(name).lower().split())
 
 
 def get_stored_refresh_token():
-    r = requests.get(
+    r = SESSION_SB.get(
         f"{SUPABASE_URL}/rest/v1/app_settings?key=eq.hubstaff_refresh_token&select=value",
-        headers=HEADERS_SB,
     )
     if r.status_code == 200:
-        rows = r.json()
+        rows = orjson.loads(r.content)
         if rows and rows[0].get("value"):
             return rows[0]["value"]
     return None
 
 def store_refresh_token(token):
-    requests.post(
+    SESSION_SB.post(
+        f"{SUPABASE_URL}/rest/v1/app_settings?on_conflict=key",
+        data=orjson.dumps({"key": "hubstaff_refresh_token", "value": token}),
+    )
+
+def _get_cached_setting(key):
+    """Read a JSON value cached in app_settings by a previous run, or None."""
+    r = SESSION_SB.get(f"{SUPABASE_URL}/rest/v1/app_settings?key=eq.{key}&select=value")
+    if r.status_code == 200:
+        rows = orjson.loads(r.content)
+        if rows and rows[0].get("value"):
+            value = rows[0]["value"]
+            try:
+                return orjson.loads(value) if isinstance(value, str) else value
+            except ValueError:
+                pass
+    return None
+
+def _store_cached_setting(key, value):
+    SESSION_SB.post(
         f"{SUPABASE_URL}/rest/v1/app_settings?on_conflict=key",
-        headers={**HEADERS_SB, "Prefer": "resolution=merge-duplicates"},
-        json={"key": "hubstaff_refresh_token", "value": token},
+        data=orjson.dumps({"key": key, "value": orjson.dumps(value).decode()}),
     )
 
+def get_stored_access_token():
+    """Return (token, expiry_epoch) cached by a previous run, or (None, 0)."""
+    cached = _get_cached_setting("hubstaff_access_token")
+    try:
+        return cached["token"], float(cached["exp"])
+    except (ValueError, KeyError, TypeError):
+        return None, 0
+
+def store_access_token(token, expires_in):
+    # Expire our copy a minute early so a run never starts with a token about to lapse
+    _store_cached_setting("hubstaff_access_token", {"token": token, "exp": time.time() + expires_in - 60})
+
 def exchange_for_access_token(refresh_token):
-    r = requests.post(TOKEN_ENDPOINT, data={
+    r = SESSION_TOKEN.post(TOKEN_ENDPOINT, data={
         "grant_type": "refresh_token",
         "refresh_token": refresh_token,
     })
     if r.status_code != 200:
         print(f"  Warning: Token exchange failed ({r.status_code}): {r.text[:200]}")
-        return None, None
-    data = r.json()
+        return None, None, None
+    data = orjson.loads(r.content)
     access_token = data.get("access_token")
     new_refresh = data.get("refresh_token")
-    expires_in = data.get("expires_in", "?")
-    print(f"  Access token obtained (expires in {expires_in}s)")
-    return access_token, new_refresh
+    expires_in = data.get("expires_in")
+    print(f"  Access token obtained (expires in {expires_in or '?'}s)")
+    return access_token, new_refresh, expires_in
 
 def hubstaff_get(path, access_token, params=None):
-    r = requests.get(
+    r = SESSION_HS.get(
         f"https://api.hubstaff.com/v2/{path}",
         headers={"Authorization": f"Bearer {access_token}"},
         params=params or {},
     )
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
+
+def _lookup_user_name(uid, access_token):
+    try:
+        data = hubstaff_get(f"users/{uid}", access_token)
+        return uid, data.get("user", {}).get("name", "")
+    except Exception:
+        return uid, None
+
+def lookup_user_names(user_ids, access_token):
+    """Fetch users/{uid} concurrently. Returns [(uid, name)], name is None if the lookup failed."""
+    with ThreadPoolExecutor(max_workers=USER_LOOKUP_WORKERS) as ex:
+        return list(ex.map(lambda uid: _lookup_user_name(uid, access_token), user_ids))
 
 def get_user_names(org_id, access_token):
-    """Get user_id → name mapping by fetching each user's profile."""
+    """Get user_id → name mapping from the members list (users sideloaded)."""
     user_ids = []
+    name_map = {}
     page_start = None
     while True:
-        params = {"page_limit": 100}
+        params = {"page_limit": 100, "include": "users"}
         if page_start:
             params["page_start_id"] = page_start
         data = hubstaff_get(f"organizations/{org_id}/members", access_token, params)
         members = data.get("members", [])
         if not members:
             break
-        for m in members:
-            uid = m.get("user_id")
-            if uid:
-                user_ids.append(uid)
+        page_ids = [m["user_id"] for m in members if m.get("user_id")]
+        user_ids.extend(page_ids)
+        page_set = set(page_ids)
+        for u in data.get("users", []):
+            if u.get("id") in page_set and u.get("name"):
+                name_map[u["id"]] = u["name"]
         if len(members) < 100:
             break
         page_start = members[-1].get("id")
 
-    name_map = {}
-    for uid in user_ids:
-        try:
-            data = hubstaff_get(f"users/{uid}", access_token)
-            user = data.get("user", {})
-            name = user.get("name", "")
-            if name:
-                name_map[uid] = name
-        except Exception:
+    # Per-user profile fetch only for members the sideload didn't name
+    unseen = [uid for uid in user_ids if uid not in name_map]
+    for uid, name in lookup_user_names(unseen, access_token):
+        if name is None:
             name_map[uid] = f"User {uid}"
+        elif name:
+            name_map[uid] = name
     return name_map
 
-def get_lookback_days():
-    """Parse --backfill N from CLI args, otherwise use default."""
-    args = sys.argv[1:]
-    for i, arg in enumerate(args):
-        if arg == "--backfill" and i + 1 < len(args):
-            try:
-                days = int(args[i + 1])
-                return min(days, MAX_BACKFILL_DAYS)
-            except ValueError:
-                pass
-    return DEFAULT_LOOKBACK_DAYS
+def upsert_hours(rows):
+    """Upsert chatter_hours rows in one request; split in half only if the payload is too large."""
+    r = SESSION_SB.post(
+        f"{SUPABASE_URL}/rest/v1/chatter_hours?on_conflict=chatter_id,date",
+        data=orjson.dumps(rows),
+    )
+    if r.status_code == 413 and len(rows) > 1:
+        mid = len(rows) // 2
+        return upsert_hours(rows[:mid]) + upsert_hours(rows[mid:])
+    if r.status_code not in (200, 201):
+        print(f"  ERROR upserting {len(rows)} records: {r.status_code} {r.text[:300]}")
+        return 0
+    return len(rows)
+
+def get_cached_member_map(org_id):
+    """Return ({user_id: name}, cached_at_epoch) stored by a previous run, or ({}, 0)."""
+    cached = _get_cached_setting(f"hubstaff_members_{org_id}")
+    try:
+        members = {int(uid): name for uid, name in cached["members"].items()}
+        return members, float(cached["cached_at"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return {}, 0
+
+def store_member_map(org_id, member_names, cached_at):
+    # Placeholder names from failed lookups aren't cached, so they get retried next run
+    members = {str(uid): n for uid, n in member_names.items() if n != f"User {uid}"}
+    _store_cached_setting(f"hubstaff_members_{org_id}", {"cached_at": cached_at, "members": members})
+
+def iter_daily_activities(org_id, access_token, start_date, end_date):
+    """Yield pages of an org's daily activities for the date range."""
+    page_start = None
+    while True:
+        params = {
+            "date[start]": start_date,
+            "date[stop]": end_date,
+            "page_limit": 500,
+        }
+        if page_start:
+            params["page_start_id"] = page_start
+        data = hubstaff_get(f"organizations/{org_id}/activities/daily", access_token, params)
+        page_acts = data.get("daily_activities", [])
+        if page_acts:
+            yield page_acts
+        if len(page_acts) < 500:
+            break
+        page_start = page_acts[-1].get("id")
+
+def fetch_active_chatters():
+    """Load active chatters — matched by hubstaff_user_id first, name as fallback.
+
+    A snapshot of the chatters table is kept in app_settings; each run only pulls
+    rows whose updated_at moved past it, and re-reads the whole table once a day.
+    """
+    select = "id,full_name,hubstaff_user_id,status,updated_at"
+    snapshot = _get_cached_setting(CHATTER_SNAPSHOT_KEY)
+    fresh = (
+        isinstance(snapshot, dict)
+        and snapshot.get("chatters") is not None
+        and time.time() - snapshot.get("cached_at", 0) < CHATTER_SNAPSHOT_TTL
+    )
 
-def sync_hours():
-    lookback_days = get_lookback_days()
-    print(f"Syncing Hubstaff hours (last {lookback_days} days)...")
+    if fresh:
+        chatters = snapshot["chatters"]
+        url = f"{SUPABASE_URL}/rest/v1/chatters?select={select}"
+        if snapshot.get("as_of"):
+            url += f"&updated_at=gt.{quote(snapshot['as_of'])}"
+    else:
+        chatters = {}
+        url = f"{SUPABASE_URL}/rest/v1/chatters?select={select}"
+        snapshot = {"cached_at": time.time(), "as_of": None}
+
+    r = SESSION_SB.get(url)
+    if r.status_code != 200:
+        # A 400 here usually means chatters_updated_at.sql hasn't been applied yet
+        print(f"  ERROR fetching chatters: {r.status_code} {r.text[:200]}")
+        return [c for c in chatters.values() if c["status"] == "Active"] if fresh else []
+    changed = orjson.loads(r.content)
+
+    # Inactive rows are kept in the snapshot so a deactivation seen in a delta sticks
+    for c in changed:
+        chatters[c["id"]] = c
+    if changed or not fresh:
+        as_of = max((c["updated_at"] for c in changed if c.get("updated_at")), default=snapshot.get("as_of"))
+        _store_cached_setting(CHATTER_SNAPSHOT_KEY, {
+            "cached_at": snapshot["cached_at"],
+            "as_of": as_of,
+            "chatters": chatters,
+        })
+    print(f"  Chatter snapshot: {len(changed)} {'changed' if fresh else 'loaded'} row(s)")
+
+    return [c for c in chatters.values() if c["status"] == "Active"]
+
+def fetch_org(org, access_token, start_date, end_date):
+    """Fetch one org's members and activities for the date range.
+
+    Returns (member_names, acts_by_user, tracked_by_user, log): activity counts per
+    hubstaff user_id, tracked seconds per (user_id, date), and lines to print.
+    """
+    org_id = org["id"]
+    log = []
+
+    member_names, cached_at = get_cached_member_map(org_id)
+    if member_names and time.time() - cached_at < MEMBER_CACHE_TTL:
+        log.append(f"Members: {len(member_names)} (cached)")
+    else:
+        member_names = get_user_names(org_id, access_token)
+        cached_at = time.time()
+        store_member_map(org_id, member_names, cached_at)
+        log.append(f"Members: {len(member_names)}")
+
+    # Process activities page by page so only one page is held in memory
+    acts_by_user = defaultdict(int)
+    tracked_by_user = defaultdict(int)
+    activity_count = 0
+    resolved = 0
+    attempted_ids = set()  # user_ids already looked up this run — failures aren't retried every page
+    for page_acts in iter_daily_activities(org_id, access_token, start_date, end_date):
+        activity_count += len(page_acts)
+
+        # Fold the page into the per-user totals in a single pass, then drop it
+        missing_ids = set()
+        for act in page_acts:
+            user_id = act.get("user_id")
+            acts_by_user[user_id] += 1
+            if user_id and user_id not in member_names and user_id not in attempted_ids:
+                missing_ids.add(user_id)
 
+            tracked_seconds = act.get("tracked", 0)
+            date = act.get("date", "")
+
+            # Daily activities are split per project/task — sum raw seconds, round once later
+            if date and tracked_seconds > 0:
+                tracked_by_user[(user_id, date)] += tracked_seconds
+
+        # Resolve any activity user_ids not in member list
+        attempted_ids |= missing_ids
+        for uid, name in lookup_user_names(missing_ids, access_token):
+            if name:
+                member_names[uid] = name
+                resolved += 1
+
+    log.append(f"Activities: {activity_count} records ({start_date} to {end_date})")
+
+    if resolved:
+        # Keep the original cached_at so the roster is still fully refreshed on schedule
+        store_member_map(org_id, member_names, cached_at)
+
+    return member_names, acts_by_user, tracked_by_user, log
+
+def get_lookback_days(argv=None):
+    """Parse --backfill N from CLI args (capped at MAX_BACKFILL_DAYS), otherwise use default."""
+    parser = argparse.ArgumentParser(description="Sync Hubstaff hours into Supabase")
+    parser.add_argument("--backfill", type=int, default=DEFAULT_LOOKBACK_DAYS,
+                        help=f"days to look back (default {DEFAULT_LOOKBACK_DAYS}, max {MAX_BACKFILL_DAYS})")
+    args = parser.parse_args(argv)
+    return min(args.backfill, MAX_BACKFILL_DAYS)
+
+def refresh_access_token():
+    """Exchange the stored (or env) refresh token for a new access token and cache both.
+    Returns None if no token could be obtained."""
     refresh_token = get_stored_refresh_token() or HUBSTAFF_REFRESH_TOKEN
-    access_token, new_refresh = exchange_for_access_token(refresh_token)
+    access_token, new_refresh, expires_in = exchange_for_access_token(refresh_token)
 
     if not access_token:
         if refresh_token != HUBSTAFF_REFRESH_TOKEN:
             print("  Retrying with original env token...")
-            access_token, new_refresh = exchange_for_access_token(HUBSTAFF_REFRESH_TOKEN)
+            access_token, new_refresh, expires_in = exchange_for_access_token(HUBSTAFF_REFRESH_TOKEN)
         if not access_token:
             print("  ERROR: Cannot obtain access token")
-            return
+            return None
 
     if new_refresh:
         store_refresh_token(new_refresh)
         print("  New refresh token stored")
+    if isinstance(expires_in, (int, float)):
+        store_access_token(access_token, expires_in)
+    return access_token
+
+def sync_hours(lookback_days=DEFAULT_LOOKBACK_DAYS):
+    print(f"Syncing Hubstaff hours (last {lookback_days} days)...")
+    now = datetime.now(timezone.utc)
+    sync_at = now.isoformat()
+    end_date = now.strftime("%Y-%m-%d")
+    start_date = (now - timedelta(days=lookback_days)).strftime("%Y-%m-%d")
+
+    # The chatter roster doesn't need a Hubstaff token — load it while auth + orgs run
+    prefetch = ThreadPoolExecutor(max_workers=1)
+    chatters_future = prefetch.submit(fetch_active_chatters)
+    prefetch.shutdown(wait=False)
+
+    cached_token, cached_exp = get_stored_access_token()
+    token_ttl = cached_exp - time.time()
+    if cached_token and token_ttl > ACCESS_TOKEN_MIN_TTL:
+        access_token = cached_token
+        print(f"  Reusing cached access token (valid for {int(token_ttl)}s)")
+    else:
+        cached_token = None
+        access_token = refresh_access_token()
+        if not access_token:
+            return
 
-    orgs = hubstaff_get("organizations", access_token).get("organizations", [])
+    try:
+        orgs = hubstaff_get("organizations", access_token).get("organizations", [])
+    except requests.HTTPError as e:
+        # A cached token can be revoked early (e.g. by map_hubstaff_users rotating it) — refresh once
+        if not cached_token or e.response is None or e.response.status_code != 401:
+            raise
+        print("  Cached access token rejected (401), refreshing...")
+        _store_cached_setting("hubstaff_access_token", {"token": None, "exp": 0})
+        access_token = refresh_access_token()
+        if not access_token:
+            return
+        orgs = hubstaff_get("organizations", access_token).get("organizations", [])
     if not orgs:
         print("  ERROR: No organizations found")
         return
@@ -160,12 +449,7 @@ def sync_hours():
     active_orgs = [o for o in orgs if o["id"] not in SKIP_ORGS]
     print(f"  Organizations: {len(active_orgs)} active (skipping {len(SKIP_ORGS)} legacy)")
 
-    # Load chatters from Supabase — prefer hubstaff_user_id, fall back to name
-    r = requests.get(
-        f"{SUPABASE_URL}/rest/v1/chatters?select=id,full_name,hubstaff_user_id&status=eq.Active",
-        headers=HEADERS_SB,
-    )
-    chatters = r.json() if r.status_code == 200 else []
+    chatters = chatters_future.result()
 
     chatter_by_hsid = {}   # hubstaff_user_id (int) → chatter UUID
     chatter_by_name = {}   # normalized name → chatter UUID
@@ -180,98 +464,54 @@ def sync_hours():
 
     print(f"  Supabase chatters loaded: {len(chatters)} ({mapped_count} with hubstaff_user_id)")
 
-    end_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    start_date = (datetime.now(timezone.utc) - timedelta(days=lookback_days)).strftime("%Y-%m-%d")
-    all_rows = []
-    seen_keys = set()
+    # Orgs are independent — fetch them concurrently, then match against chatters serially
+    with ThreadPoolExecutor(max_workers=max(1, len(active_orgs))) as ex:
+        org_results = list(ex.map(
+            lambda org: fetch_org(org, access_token, start_date, end_date), active_orgs,
+        ))
+
+    tracked_by_key = defaultdict(int)  # (chatter_id, date) → tracked seconds, summed across orgs
     unmatched = {}         # name → hubstaff user_id (for logging)
     matched_by_id = 0
     matched_by_name = 0
 
-    for org in active_orgs:
+    for org, (member_names, acts_by_user, tracked_by_user, log) in zip(active_orgs, org_results):
         org_id = org["id"]
-        org_name = org.get("name", f"Org {org_id}")
-        print(f"\n  --- {org_name} (ID: {org_id}) ---")
-
-        member_names = get_user_names(org_id, access_token)
-        print(f"    Members: {len(member_names)}")
-
-        # Fetch activities
-        activities = []
-        page_start = None
-        while True:
-            params = {
-                "date[start]": start_date,
-                "date[stop]": end_date,
-                "page_limit": 500,
-            }
-            if page_start:
-                params["page_start_id"] = page_start
-            data = hubstaff_get(f"organizations/{org_id}/activities/daily", access_token, params)
-            page_acts = data.get("daily_activities", [])
-            activities.extend(page_acts)
-            if len(page_acts) < 500:
-                break
-            page_start = page_acts[-1].get("id")
-
-        print(f"    Activities: {len(activities)} records ({start_date} to {end_date})")
-
-        # Resolve any activity user_ids not in member list
-        missing_ids = set()
-        for act in activities:
-            uid = act.get("user_id")
-            if uid and uid not in member_names:
-                missing_ids.add(uid)
-        for uid in missing_ids:
-            try:
-                data = hubstaff_get(f"users/{uid}", access_token)
-                user = data.get("user", {})
-                name = user.get("name", "")
-                if name:
-                    member_names[uid] = name
-            except Exception:
-                pass
-
-        for act in activities:
-            user_id = act.get("user_id")
-            user_name = member_names.get(user_id, "")
+        print(f"\n  --- {org.get('name', f'Org {org_id}')} (ID: {org_id}) ---")
+        for line in log:
+            print(f"    {line}")
 
+        chatter_for_user = {}
+        for user_id, n_acts in acts_by_user.items():
             # Strategy 1: match by hubstaff_user_id
             chatter_id = chatter_by_hsid.get(user_id)
             if chatter_id:
-                matched_by_id += 1
+                matched_by_id += n_acts
             else:
                 # Strategy 2: fallback to normalized name
-                chatter_key = normalize(user_name)
-                chatter_id = chatter_by_name.get(chatter_key)
+                chatter_id = chatter_by_name.get(normalize(member_names.get(user_id) or ""))
                 if chatter_id:
-                    matched_by_name += 1
-
-            if not chatter_id:
-                if user_name:
-                    unmatched[user_name] = user_id
-                continue
-
-            tracked_seconds = act.get("tracked", 0)
-            hours = round(tracked_seconds / 3600, 2)
-            date = act.get("date", "")
+                    matched_by_name += n_acts
+            if chatter_id:
+                chatter_for_user[user_id] = chatter_id
+            elif member_names.get(user_id):
+                unmatched[member_names[user_id]] = user_id
 
-            if date and hours > 0:
-                dedup_key = f"{chatter_id}:{date}"
-                if dedup_key in seen_keys:
-                    for row in all_rows:
-                        if row["chatter_id"] == chatter_id and row["date"] == date:
-                            row["hours_worked"] = round(row["hours_worked"] + hours, 2)
-                            break
-                else:
-                    seen_keys.add(dedup_key)
-                    all_rows.append({
-                        "chatter_id": chatter_id,
-                        "date": date,
-                        "hours_worked": hours,
-                        "synced_at": datetime.now(timezone.utc).isoformat(),
-                    })
+        for (user_id, date), seconds in tracked_by_user.items():
+            chatter_id = chatter_for_user.get(user_id)
+            if chatter_id:
+                tracked_by_key[(chatter_id, date)] += seconds
 
+    all_rows = []
+    for (chatter_id, date), seconds in tracked_by_key.items():
+        hours = round(seconds / 3600, 2)
+        if hours > 0:
+            all_rows.append({
+                "chatter_id": chatter_id,
+                "date": date,
+                "hours_worked": hours,
+                "synced_at": sync_at,
+            })
     print(f"\n  Total rows to sync: {len(all_rows)}")
     print(f"  Matched by hubstaff_user_id: {matched_by_id}")
     print(f"  Matched by name (fallback): {matched_by_name}")
@@ -283,21 +523,12 @@ def sync_hours():
             print(f"    ... and {len(unmatched) - 20} more")
 
     if all_rows:
-        for i in range(0, len(all_rows), 100):
-            chunk = all_rows[i:i+100]
-            r = requests.post(
-                f"{SUPABASE_URL}/rest/v1/chatter_hours?on_conflict=chatter_id,date",
-                headers={**HEADERS_SB, "Prefer": "resolution=merge-duplicates"},
-                json=chunk,
-            )
-            if r.status_code in (200, 201):
-                print(f"  Synced batch {i//100 + 1}: {len(chunk)} records")
-            else:
-                print(f"  ERROR batch {i//100 + 1}: {r.status_code} {r.text[:300]}")
+        synced = upsert_hours(all_rows)
+        print(f"  Synced {synced}/{len(all_rows)} records")
     else:
         print("  WARNING: No matching hour records found")
 
 if __name__ == "__main__":
     print(f"Hubstaff sync started at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}")
-    sync_hours()
+    sync_hours(get_lookback_days())
     print("Hubstaff sync complete!")
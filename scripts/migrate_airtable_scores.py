@@ -4,6 +4,10 @@ Migrate historical Chatter Score data from Airtable to Supabase.
 Requires:
   - AIRTABLE_TOKEN env var
   - SUPABASE_URL and SUPABASE_SERVICE_KEY env vars (service role for bypassing RLS)
+  - rapidfuzz (optional, pip install rapidfuzz) — much faster fuzzy name matching
+  - orjson (optional, pip install orjson) — faster JSON encode/decode for the bulk inserts
+  - SUPABASE_DB_URL env var + psycopg (optional, pip install "psycopg[binary]") — load
+    score_events with COPY over a direct Postgres connection instead of PostgREST
 
 Airtable source table: "Chatter Score" (tbljQun5AMLAfFtzX)
 
@@ -14,25 +18,79 @@ Usage:
 import os
 import sys
 import json
-import time
 import re
-from datetime import datetime, timedelta
-from difflib import SequenceMatcher
+import functools
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 except ImportError:
     print("ERROR: 'requests' package required. Install with: pip install requests")
     sys.exit(1)
 
+try:
+    import orjson
+    json_dumps, json_loads = orjson.dumps, orjson.loads
+except ImportError:
+    json_dumps, json_loads = (lambda obj: json.dumps(obj).encode()), json.loads
+
+try:
+    from rapidfuzz import process as rf_process, fuzz as rf_fuzz
+except ImportError:
+    rf_process = None
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
 AIRTABLE_TOKEN = os.environ.get("AIRTABLE_TOKEN")
 SUPABASE_URL = os.environ.get("SUPABASE_URL", "https://bnmrdlqqzxenyqjknqhy.supabase.co")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
+SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")
 
 AIRTABLE_BASE_ID = "appy0qGaMEfyDz9LZ"
 AIRTABLE_TABLE_ID = "tbljQun5AMLAfFtzX"
 
 DRY_RUN = "--dry-run" in sys.argv
+INSERT_BATCH_SIZE = 500  # score_events rows per bulk POST
+FUZZY_MIN_LEN = 3  # shorter names only match exactly
+FUZZY_MIN_SCORE = 75  # fuzz.ratio (normalized Indel similarity) needed for a fuzzy chatter match
+
+# Only the columns main() reads (each has lower-case / alternate aliases across table versions)
+SCORE_FIELDS = [
+    "Chatter", "Name", "chatter_name", "Date", "date", "Points", "points",
+    "Reason", "reason", "Event", "Notes", "notes",
+]
+score_fields = list(SCORE_FIELDS)  # aliases Airtable reports as unknown are removed on the first page
+_UNKNOWN_FIELD = re.compile(r'Unknown field name: "(.+)"')
+
+
+def _make_session(headers):
+    """Keep-alive session (one TLS handshake per host) that retries transient errors.
+    Idempotent methods only, so a failed insert is never replayed. Rate limiting is
+    handled reactively: a 429 waits out its Retry-After instead of pacing every page."""
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount("https://", HTTPAdapter(
+        pool_maxsize=16,
+        max_retries=Retry(total=5, backoff_factor=0.5,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          respect_retry_after_header=True, raise_on_status=False),
+    ))
+    return session
+
+
+SESSION_AT = _make_session({"Authorization": f"Bearer {AIRTABLE_TOKEN}"})
+SESSION_SB = _make_session({
+    "apikey": SUPABASE_SERVICE_KEY or "",
+    "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+})
+# Per-request additions merged onto SESSION_SB's auth headers for writes
+SB_WRITE_HEADERS = {"Content-Type": "application/json", "Prefer": "return=minimal"}
 
 
 def check_env():
@@ -44,140 +102,226 @@ def check_env():
         sys.exit(1)
 
 
+def _unknown_field(resp):
+    """Name of the field an Airtable 422 UNKNOWN_FIELD_NAME response complains about, or None."""
+    try:
+        error = json_loads(resp.content).get("error", {})
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(error, dict) or error.get("type") != "UNKNOWN_FIELD_NAME":
+        return None
+    m = _UNKNOWN_FIELD.search(error.get("message", ""))
+    return m.group(1) if m else None
+
+
 def airtable_get(offset=None):
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_ID}"
-    headers = {"Authorization": f"Bearer {AIRTABLE_TOKEN}"}
     params = {"pageSize": 100}
+    if score_fields:
+        params["fields[]"] = score_fields
     if offset:
         params["offset"] = offset
 
-    resp = requests.get(url, headers=headers, params=params)
+    resp = SESSION_AT.get(url, params=params)
+    if resp.status_code == 422 and score_fields and not offset:
+        # Only some alias spellings exist in this table — drop the one Airtable rejected and retry
+        unknown = _unknown_field(resp)
+        if unknown in score_fields:
+            score_fields.remove(unknown)
+            return airtable_get()
     resp.raise_for_status()
-    return resp.json()
+    return json_loads(resp.content)
 
 
-def fetch_all_airtable_records():
-    records = []
-    offset = None
+def iter_airtable_records(first_page=None):
+    """Yield Chatter Score records page by page; pass an already-fetched first page to continue from it."""
+    data = first_page if first_page is not None else airtable_get()
     while True:
-        data = airtable_get(offset)
-        records.extend(data.get("records", []))
+        yield from data.get("records", [])
         offset = data.get("offset")
         if not offset:
             break
-        time.sleep(0.25)
-    return records
+        data = airtable_get(offset)
 
 
 def supabase_request(method, path, body=None):
     url = f"{SUPABASE_URL}/rest/v1/{path}"
-    headers = {
-        "apikey": SUPABASE_SERVICE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "return=minimal",
-    }
-    resp = requests.request(method, url, headers=headers, json=body)
+    resp = SESSION_SB.request(method, url, headers=SB_WRITE_HEADERS, data=json_dumps(body) if body is not None else None)
     if resp.status_code >= 400:
         print(f"  Supabase error {resp.status_code}: {resp.text[:200]}")
     return resp
 
 
+SCORE_EVENT_COLUMNS = ("chatter_id", "submitted_by", "date", "event_type_id",
+                       "points", "custom_points", "notes", "week")
+_db_conn = None
+_copy_enabled = bool(SUPABASE_DB_URL and psycopg)
+
+
+def copy_score_events(rows):
+    """COPY rows straight into Postgres in one transaction. Returns False (nothing
+    written) if the direct connection isn't configured or the COPY fails; after a
+    failure the rest of the run goes through PostgREST."""
+    global _db_conn, _copy_enabled
+    if not _copy_enabled:
+        return False
+    try:
+        if _db_conn is None:
+            _db_conn = psycopg.connect(SUPABASE_DB_URL)
+        with _db_conn.cursor() as cur:
+            with cur.copy(f"COPY public.score_events ({', '.join(SCORE_EVENT_COLUMNS)}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row([row[c] for c in SCORE_EVENT_COLUMNS])
+        _db_conn.commit()
+        return True
+    except psycopg.Error as e:
+        print(f"  COPY failed, using PostgREST for the rest of the run: {str(e)[:200]}")
+        _copy_enabled = False
+        if _db_conn is not None and not _db_conn.closed:
+            _db_conn.rollback()
+        return False
+
+
+def insert_score_events(rows):
+    """Insert rows with COPY when SUPABASE_DB_URL is set, else in one bulk POST; on
+    failure retry row by row so one bad row doesn't drop the batch.
+    Returns the number of rows inserted."""
+    if copy_score_events(rows):
+        return len(rows)
+    resp = supabase_request("POST", "score_events", rows)
+    if resp.status_code < 300:
+        return len(rows)
+    if len(rows) == 1:
+        return 0
+    return sum(1 for row in rows if supabase_request("POST", "score_events", row).status_code < 300)
+
+
 def fetch_chatters():
     url = f"{SUPABASE_URL}/rest/v1/chatters?select=id,full_name,team_name&status=eq.Active&airtable_role=eq.Chatter"
-    headers = {
-        "apikey": SUPABASE_SERVICE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-    }
-    resp = requests.get(url, headers=headers)
+    resp = SESSION_SB.get(url)
     resp.raise_for_status()
-    return resp.json()
+    return json_loads(resp.content)
 
 
 def fetch_event_types():
     url = f"{SUPABASE_URL}/rest/v1/score_event_types?select=id,name,points,category"
-    headers = {
-        "apikey": SUPABASE_SERVICE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-    }
-    resp = requests.get(url, headers=headers)
+    resp = SESSION_SB.get(url)
     resp.raise_for_status()
-    return resp.json()
+    return json_loads(resp.content)
+
+
+_WS = re.compile(r"\s+")
 
 
+@functools.lru_cache(maxsize=8192)
 def normalize_name(name):
     if not name:
         return ""
-    return re.sub(r"\s+", " ", name.strip().lower())
-
-
-def fuzzy_match_chatter(name, chatters_map):
+    return _WS.sub(" ", name.strip().lower())
+
+
+def _indel_ratio(a, b):
+    """0-100 similarity 2*LCS/(len(a)+len(b)) — the score rapidfuzz's fuzz.ratio computes,
+    so matches don't depend on whether rapidfuzz is installed. Bit-parallel LCS (Hyyrö)."""
+    if not a and not b:
+        return 100.0
+    masks = {}
+    for i, ch in enumerate(a):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    for ch in b:
+        u = v & masks.get(ch, 0)
+        v = ((v + u) | (v - u)) & full
+    lcs = len(a) - bin(v).count("1")
+    return 100 * 2 * lcs / (len(a) + len(b))
+
+
+def fuzzy_match_chatter(name, chatters_map, choices):
     norm = normalize_name(name)
     if norm in chatters_map:
         return chatters_map[norm]
+    # Empty/initial-only names can't be matched meaningfully — don't scan every chatter for them
+    if len(norm) < FUZZY_MIN_LEN:
+        return None
+
+    if rf_process:
+        hit = rf_process.extractOne(norm, choices, scorer=rf_fuzz.ratio, score_cutoff=FUZZY_MIN_SCORE)
+        return chatters_map[hit[0]] if hit else None
 
-    best_ratio = 0
+    # Same scorer, cutoff and first-best tie-break as extractOne above, in pure Python
+    best_score = 0
     best_match = None
-    for key, chatter in chatters_map.items():
-        ratio = SequenceMatcher(None, norm, key).ratio()
-        if ratio > best_ratio:
-            best_ratio = ratio
-            best_match = chatter
-    if best_ratio >= 0.75:
-        return best_match
-    return None
+    for key in choices:
+        score = _indel_ratio(norm, key)
+        if score > best_score:
+            best_score = score
+            best_match = chatters_map[key]
+    return best_match if best_score >= FUZZY_MIN_SCORE else None
 
 
+# Records cluster on a few hundred distinct dates, so both helpers are memoized
+@functools.lru_cache(maxsize=4096)
 def get_week_key(date_str):
-    d = datetime.strptime(date_str, "%Y-%m-%d")
+    d = date.fromisoformat(date_str)
     iso = d.isocalendar()
     return f"{iso[0]}-W{iso[1]:02d}"
 
 
+@functools.lru_cache(maxsize=4096)
 def get_week_start(date_str):
-    d = datetime.strptime(date_str, "%Y-%m-%d")
+    d = date.fromisoformat(date_str)
     monday = d - timedelta(days=d.weekday())
-    return monday.strftime("%Y-%m-%d")
+    return monday.isoformat()
 
 
 def main():
     check_env()
 
-    print("Fetching Airtable records...")
-    records = fetch_all_airtable_records()
-    print(f"  Found {len(records)} records")
+    print("Fetching Supabase chatters, event types and the first Airtable page...")
+    # Independent reads — overlap their network waits
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        first_page_future = ex.submit(airtable_get)
+        chatters_future = ex.submit(fetch_chatters)
+        event_types_future = ex.submit(fetch_event_types)
+    first_page = first_page_future.result()
+    chatters = chatters_future.result()
+    event_types = event_types_future.result()
 
-    print("Fetching Supabase chatters...")
-    chatters = fetch_chatters()
     chatters_map = {normalize_name(c["full_name"]): c for c in chatters}
+    chatter_choices = list(chatters_map)
+    chatter_by_name = {}  # raw Airtable name → matched chatter (or None)
     print(f"  Found {len(chatters)} active chatters")
 
-    print("Fetching event types...")
-    event_types = fetch_event_types()
     others_type = next((t for t in event_types if t["category"] == "custom"), None)
     type_by_name = {normalize_name(t["name"]): t for t in event_types}
+    reason_to_type = {}  # raw reason → event type (or None)
     print(f"  Found {len(event_types)} event types")
 
     unmatched_names = set()
     events_created = 0
     events_skipped = 0
+    events_duplicate = 0
+    seen_events = set()  # full event rows (minus submitted_by) already queued
+    rows = []
 
     # System user ID for submitted_by (will use first owner profile or skip)
     system_user_url = f"{SUPABASE_URL}/rest/v1/profiles?select=id&role=eq.owner&limit=1"
-    headers = {
-        "apikey": SUPABASE_SERVICE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-    }
-    system_resp = requests.get(system_user_url, headers=headers)
-    system_profiles = system_resp.json()
+    system_resp = SESSION_SB.get(system_user_url)
+    system_profiles = json_loads(system_resp.content)
     system_user_id = system_profiles[0]["id"] if system_profiles else None
 
     if not system_user_id:
         print("ERROR: No owner profile found for submitted_by")
         sys.exit(1)
 
-    print(f"\nProcessing {len(records)} records...")
-    for rec in records:
+    # Records stream page by page into compact event rows, but nothing is written until every
+    # page is read and parsed: score_events has no unique key, so a fetch or parse failure
+    # halfway through would otherwise leave a partial, non-resumable migration
+    print("\nProcessing Airtable records...")
+    record_count = 0
+    for rec in iter_airtable_records(first_page):
+        record_count += 1
         fields = rec.get("fields", {})
 
         chatter_name = fields.get("Chatter") or fields.get("Name") or fields.get("chatter_name")
@@ -188,9 +332,15 @@ def main():
         if isinstance(chatter_name, list):
             chatter_name = chatter_name[0] if chatter_name else ""
 
-        chatter = fuzzy_match_chatter(str(chatter_name), chatters_map)
+        # Each distinct Airtable name is fuzzy-matched once; repeats are a dict hit
+        chatter_name = str(chatter_name)
+        if chatter_name in chatter_by_name:
+            chatter = chatter_by_name[chatter_name]
+        else:
+            chatter = fuzzy_match_chatter(chatter_name, chatters_map, chatter_choices)
+            chatter_by_name[chatter_name] = chatter
         if not chatter:
-            unmatched_names.add(str(chatter_name))
+            unmatched_names.add(chatter_name)
             events_skipped += 1
             continue
 
@@ -210,9 +360,13 @@ def main():
         reason = fields.get("Reason") or fields.get("reason") or fields.get("Event") or ""
         notes = fields.get("Notes") or fields.get("notes") or ""
 
-        matched_type = type_by_name.get(normalize_name(str(reason)))
-        if not matched_type and others_type:
-            matched_type = others_type
+        # Few distinct reasons repeat across thousands of records — resolve each one once
+        reason_key = str(reason)
+        if reason_key in reason_to_type:
+            matched_type = reason_to_type[reason_key]
+        else:
+            matched_type = type_by_name.get(normalize_name(reason_key)) or others_type
+            reason_to_type[reason_key] = matched_type
 
         if not matched_type:
             events_skipped += 1
@@ -231,23 +385,37 @@ def main():
             "week": week_key,
         }
 
+        # Airtable holds some duplicated score rows — migrate the first, skip exact copies.
+        # Every written column except submitted_by (constant) is part of the key.
+        dedup_key = tuple(event_payload[c] for c in SCORE_EVENT_COLUMNS if c != "submitted_by")
+        if dedup_key in seen_events:
+            events_duplicate += 1
+            continue
+        seen_events.add(dedup_key)
+
         if DRY_RUN:
             print(f"  [DRY RUN] Would create event: {chatter['full_name']} | {date_str} | {points} pts | {reason}")
         else:
-            resp = supabase_request("POST", "score_events", event_payload)
-            if resp.status_code < 300:
-                events_created += 1
-            else:
-                events_skipped += 1
-            time.sleep(0.1)
+            rows.append(event_payload)
+
+    print(f"  Found {record_count} records")
+
+    # Every record parsed cleanly — now insert in batches
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[i:i + INSERT_BATCH_SIZE]
+        inserted = insert_score_events(batch)
+        events_created += inserted
+        events_skipped += len(batch) - inserted
+        print(f"  ... {events_created} events created so far")
 
-        if not DRY_RUN and events_created % 50 == 0 and events_created > 0:
-            print(f"  ... {events_created} events created so far")
+    if _db_conn is not None:
+        _db_conn.close()
 
     print(f"\n=== MIGRATION SUMMARY ===")
-    print(f"Total Airtable records: {len(records)}")
+    print(f"Total Airtable records: {record_count}")
     print(f"Events created: {events_created}")
     print(f"Events skipped: {events_skipped}")
+    print(f"Duplicate records skipped: {events_duplicate}")
 
     if unmatched_names:
         print(f"\nUnmatched chatter names ({len(unmatched_names)}):")
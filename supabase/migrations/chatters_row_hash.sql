@@ -0,0 +1,3 @@
+-- Content hash of the Airtable-sourced chatter fields, written by
+-- pipeline/sync_airtable.py so unchanged rows can be skipped on each sync.
+ALTER TABLE public.chatters ADD COLUMN IF NOT EXISTS row_hash TEXT;
@@ -0,0 +1,11 @@
+-- Track when each chatter row last changed so pipeline/sync_hubstaff.py can
+-- pull only rows modified since its cached snapshot instead of the full table.
+-- Reuses update_updated_at() from migration_v3_tasks_and_docs.sql.
+ALTER TABLE public.chatters ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+DROP TRIGGER IF EXISTS chatters_updated_at ON public.chatters;
+CREATE TRIGGER chatters_updated_at
+  BEFORE UPDATE ON public.chatters
+  FOR EACH ROW EXECUTE FUNCTION update_updated_at();
+
+CREATE INDEX IF NOT EXISTS idx_chatters_updated_at ON public.chatters(updated_at);
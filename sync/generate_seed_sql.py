@@ -6,11 +6,29 @@ import os
 import requests
 import json
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 AIRTABLE_TOKEN = os.environ.get("AIRTABLE_TOKEN", "")
 BASE_ID = "appy0qGaMEfyDz9LZ"
 HEADERS = {"Authorization": f"Bearer {AIRTABLE_TOKEN}"}
 
+# One keep-alive connection for every Airtable page; transient 429/5xx are retried with backoff
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+))
+
 
 def fetch_all(table_id, params=None):
     url = f"https://api.airtable.com/v0/{BASE_ID}/{table_id}"
@@ -20,9 +38,9 @@ def fetch_all(table_id, params=None):
         p = dict(params or {})
         if offset:
             p["offset"] = offset
-        r = requests.get(url, headers=HEADERS, params=p)
+        r = SESSION.get(url, params=p)
         r.raise_for_status()
-        data = r.json()
+        data = json_loads(r.content)
         records.extend(data.get("records", []))
         offset = data.get("offset")
         if not offset:
@@ -30,6 +48,24 @@ def fetch_all(table_id, params=None):
     return records
 
 
+MODEL_INSERT = (
+    "INSERT INTO public.models (airtable_id, name, status, page_type, profile_picture_url, niche, traffic_sources, chatbot_active, scripts_url, team_names) VALUES\n"
+    "%s\n"
+    "ON CONFLICT (airtable_id) DO UPDATE SET name=EXCLUDED.name, status=EXCLUDED.status, page_type=EXCLUDED.page_type, "
+    "profile_picture_url=EXCLUDED.profile_picture_url, niche=EXCLUDED.niche, traffic_sources=EXCLUDED.traffic_sources, "
+    "chatbot_active=EXCLUDED.chatbot_active, scripts_url=EXCLUDED.scripts_url, team_names=EXCLUDED.team_names, synced_at=NOW();"
+)
+MODEL_VALUES = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+CHATTER_INSERT = (
+    "INSERT INTO public.chatters (airtable_id, full_name, status, airtable_role, team_name, favorite_shift) VALUES\n"
+    "%s\n"
+    "ON CONFLICT (airtable_id) DO UPDATE SET full_name=EXCLUDED.full_name, status=EXCLUDED.status, "
+    "airtable_role=EXCLUDED.airtable_role, team_name=EXCLUDED.team_name, favorite_shift=EXCLUDED.favorite_shift, synced_at=NOW();"
+)
+CHATTER_VALUES = "(%s, %s, %s, %s, %s, %s)"
+
+
 def escape_sql(s):
     if s is None:
         return "NULL"
@@ -39,23 +75,23 @@ def escape_sql(s):
 def pg_array(items):
     if not items:
         return "'{}'::TEXT[]"
-    escaped = [str(i).replace("'", "''") for i in items]
-    return "ARRAY[" + ",".join(f"'{x}'" for x in escaped) + "]::TEXT[]"
+    return "ARRAY[" + ",".join([escape_sql(i) for i in items]) + "]::TEXT[]"
 
 
 def main():
-    print("Fetching models from Airtable...")
-    models = fetch_all("tbl97sE9V8wbcgjAJ")
+    print("Fetching models, active chatters and teams from Airtable...")
+    # Each table paginates serially, but the three tables can be read side by side
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        models_future = ex.submit(fetch_all, "tbl97sE9V8wbcgjAJ")
+        chatters_future = ex.submit(fetch_all, "tblBrbCZyL5ub48zc", {
+            "filterByFormula": "OR({⚡️Status}='Active',{⚡️Status}='Probation')"
+        })
+        teams_future = ex.submit(fetch_all, "tblGTOPvVCQTbEHsW")
+    models = models_future.result()
+    chatters = chatters_future.result()
+    teams = teams_future.result()
     print(f"  Got {len(models)} models")
-
-    print("Fetching active chatters...")
-    chatters = fetch_all("tblBrbCZyL5ub48zc", {
-        "filterByFormula": "OR({⚡️Status}='Active',{⚡️Status}='Probation')"
-    })
     print(f"  Got {len(chatters)} chatters")
-
-    print("Fetching teams...")
-    teams = fetch_all("tblGTOPvVCQTbEHsW")
     print(f"  Got {len(teams)} teams")
 
     # Build team maps
@@ -77,9 +113,9 @@ def main():
     sql_lines.append("-- CW Hub — Seed Data (auto-generated from Airtable)")
     sql_lines.append("-- Run this in Supabase SQL Editor\n")
 
-    # Models
+    # Models — one multi-row INSERT (Airtable record ids are unique, so ON CONFLICT never hits a row twice)
     sql_lines.append("-- === MODELS ===")
-    model_count = 0
+    model_values = []
     for r in models:
         f = r.get("fields", {})
         name = f.get("Model Name", "").strip()
@@ -99,19 +135,17 @@ def main():
         if pics and isinstance(pics, list) and len(pics) > 0:
             pic_url = pics[0].get("url") if isinstance(pics[0], dict) else None
 
-        sql_lines.append(
-            f"INSERT INTO public.models (airtable_id, name, status, page_type, profile_picture_url, niche, traffic_sources, chatbot_active, scripts_url, team_names) "
-            f"VALUES ({escape_sql(r['id'])}, {escape_sql(name)}, {escape_sql(status)}, {escape_sql(page_type)}, {escape_sql(pic_url)}, "
-            f"{pg_array(niche)}, {pg_array(traffic)}, {str(chatbot).lower()}, {escape_sql(scripts)}, {pg_array(t_names)}) "
-            f"ON CONFLICT (airtable_id) DO UPDATE SET name=EXCLUDED.name, status=EXCLUDED.status, page_type=EXCLUDED.page_type, "
-            f"profile_picture_url=EXCLUDED.profile_picture_url, niche=EXCLUDED.niche, traffic_sources=EXCLUDED.traffic_sources, "
-            f"chatbot_active=EXCLUDED.chatbot_active, scripts_url=EXCLUDED.scripts_url, team_names=EXCLUDED.team_names, synced_at=NOW();"
-        )
-        model_count += 1
+        model_values.append(MODEL_VALUES % (
+            escape_sql(r['id']), escape_sql(name), escape_sql(status), escape_sql(page_type), escape_sql(pic_url),
+            pg_array(niche), pg_array(traffic), str(chatbot).lower(), escape_sql(scripts), pg_array(t_names),
+        ))
+    if model_values:
+        sql_lines.append(MODEL_INSERT % ",\n".join(model_values))
+    model_count = len(model_values)
 
     # Chatters (exclude Team 0 = management, only include actual chatters)
     sql_lines.append("\n-- === CHATTERS ===")
-    chatter_count = 0
+    chatter_values = []
     for r in chatters:
         f = r.get("fields", {})
         name = f.get("Full Name", "").strip()
@@ -129,14 +163,13 @@ def main():
         if role and role not in ("Chatter", "Team Leader", "TL"):
             continue
 
-        sql_lines.append(
-            f"INSERT INTO public.chatters (airtable_id, full_name, status, airtable_role, team_name, favorite_shift) "
-            f"VALUES ({escape_sql(r['id'])}, {escape_sql(name)}, {escape_sql(status)}, {escape_sql(role)}, "
-            f"{escape_sql(team)}, {escape_sql(fav_shift)}) "
-            f"ON CONFLICT (airtable_id) DO UPDATE SET full_name=EXCLUDED.full_name, status=EXCLUDED.status, "
-            f"airtable_role=EXCLUDED.airtable_role, team_name=EXCLUDED.team_name, favorite_shift=EXCLUDED.favorite_shift, synced_at=NOW();"
-        )
-        chatter_count += 1
+        chatter_values.append(CHATTER_VALUES % (
+            escape_sql(r['id']), escape_sql(name), escape_sql(status), escape_sql(role),
+            escape_sql(team), escape_sql(fav_shift),
+        ))
+    if chatter_values:
+        sql_lines.append(CHATTER_INSERT % ",\n".join(chatter_values))
+    chatter_count = len(chatter_values)
 
     sql = "\n".join(sql_lines)
 